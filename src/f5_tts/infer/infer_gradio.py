@@ -1,14 +1,36 @@
+import functools
+import os
 import re
 import tempfile
-import os
+import threading
+from collections import OrderedDict
+from importlib.resources import files
+from importlib.util import find_spec
+
+
+# keep the Inductor FX graph cache outside /tmp so compiled kernels survive restarts,
+# on the shared volume (Spaces persistent storage / k8s PV) when there is one
+if os.path.isdir("/cache"):
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", "/cache/inductor")
+else:
+    os.environ.setdefault(
+        "TORCHINDUCTOR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mnemosynth", "inductor")
+    )
+os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+# must be set before huggingface_hub is imported; hf_transfer is a dependency, but hub errors if it is enabled
+# and missing (e.g. a checkout run without installing the package), so only enable it when importable
+if find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+if os.path.isdir("/cache"):
+    os.environ.setdefault("HF_HOME", "/cache/hf")
 
 import click
 import gradio as gr
 import numpy as np
-import soundfile as sf
-import torchaudio
-from cached_path import cached_path
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import torch
+from huggingface_hub import hf_hub_download
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, StaticCache
 from num2words import num2words
 from sentence_transformers import SentenceTransformer
 import faiss
@@ -34,79 +56,332 @@ from f5_tts.infer.utils_infer import (
     load_model,
     preprocess_ref_audio_text,
     infer_process,
-    remove_silence_for_generated_wav,
+    cross_fade_waves,
+    remove_silence_from_array,
     save_spectrogram,
 )
 
-vocoder = load_vocoder()
-
+# TF32 matmuls/convs on Ampere+. no cudnn.benchmark: conv input lengths change with every request,
+# so it would re-tune the vocoder and mel convolutions each time
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
 
-# load models
+# load F5-TTS, the vocoder and Qwen lazily: --help and building the UI don't wait on their downloads, compiles
+# and warmups (the Whisper ASR pipeline and the RAG embedding model still load at import)
 F5TTS_model_cfg = dict(dim=1024, depth=22, heads=16, ff_mult=2, text_dim=512, conv_layers=4)
-F5TTS_ema_model = load_model(
-    DiT, F5TTS_model_cfg, str(cached_path("hf://jpgallegoar/F5-Spanish/model_1200000.safetensors"))
-)
 
-chat_model_state = None
-chat_tokenizer_state = None
+
+@functools.cache
+def get_vocoder():
+    return load_vocoder()
+
+
+def warmup_f5tts(model):
+    """Run one short generation so torch.compile builds the dynamic-shape DiT kernels before the first request"""
+    print("Warming up F5-TTS...")
+    infer_process(
+        str(files("f5_tts").joinpath("infer/examples/basic/basic_ref_en.wav")),
+        "Some call me nature, others call me mother nature. ",
+        " hola. ",
+        model,
+        get_vocoder(),
+    )
+
+
+@functools.cache
+def load_f5tts_model():
+    model = load_model(
+        DiT, F5TTS_model_cfg, hf_hub_download(repo_id="jpgallegoar/F5-Spanish", filename="model_1200000.safetensors")
+    )
+    # ZeroGPU Spaces only attach a GPU inside spaces.GPU calls and do not support torch.compile, run eagerly there
+    if torch.cuda.is_available() and not USING_SPACES:
+        # CFM.sample() drives the DiT once per ODE step, so compile the transformer rather than the CFM wrapper.
+        # mel duration and text length change every request: compile for dynamic shapes once, without CUDA graphs
+        # (reduce-overhead would record and keep a new graph for every length)
+        model.transformer = torch.compile(model.transformer, dynamic=True)
+        warmup_f5tts(model)
+    return model
+
+
+# one lock for every model: the background preload and the first request may race, and two compile / CUDA graph
+# warmups should not run at the same time
+model_load_lock = threading.Lock()
+
+
+def get_f5tts_model():
+    with model_load_lock:
+        return load_f5tts_model()
+
+
+chat_kv_cache = None
+chat_cache_ids = None  # token ids whose keys/values currently sit in chat_kv_cache
+chat_prompt_text = None  # previous chat template text and its token ids, to only tokenize what a turn appends
+chat_prompt_ids = None
+
+
+CHAT_MAX_NEW_TOKENS = 512
+CHAT_MAX_CACHE_LEN = 8192  # fixed KV cache size, so the decode step keeps the same shapes across turns
+CHAT_HISTORY_TURNS = 3  # turns kept after trimming conversation_state, each is (context, user, assistant)
+CHAT_HISTORY_MAX_TURNS = 2 * CHAT_HISTORY_TURNS  # trim once past this, so the cached prefix survives between trims
+
+
+def decode_one_token(model, cur_token, cache_position, past_key_values):
+    logits = model(
+        input_ids=cur_token,
+        cache_position=cache_position,
+        past_key_values=past_key_values,
+        use_cache=True,
+        return_dict=False,
+    )[0]
+    return logits[:, -1].clone()  # the CUDA graph output buffer is reused by the next replay
+
+
+chat_decode_step = decode_one_token  # swapped for the compiled step by load_chat_model on a local GPU
+
+
+def sample_next_token(logits, input_ids, temperature=0.7, top_p=0.95, top_k=None, repetition_penalty=None):
+    """Sample one token id on device, same warpers as model.generate"""
+    if repetition_penalty is not None and repetition_penalty != 1.0:
+        score = logits.gather(-1, input_ids)
+        score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+        logits.scatter_(-1, input_ids, score)
+
+    logits.div_(temperature)
+    if top_k:
+        kth = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[..., -1:]
+        logits.masked_fill_(logits < kth, float("-inf"))
+
+    probs = torch.softmax(logits, dim=-1)
+    sorted_probs, sorted_idx = torch.sort(probs, descending=True, dim=-1)
+    cumulative = torch.cumsum(sorted_probs, dim=-1)
+    sorted_probs.masked_fill_(cumulative - sorted_probs > top_p, 0.0)  # always keeps the most likely token
+    next_sorted = torch.multinomial(sorted_probs, num_samples=1)
+    return sorted_idx.gather(-1, next_sorted)
+
+
+def get_chat_kv_cache(model, prompt_ids, max_len):
+    """Reuse one StaticCache across turns and return how many prompt tokens it already holds.
+
+    Keeping the same buffers lets the captured decode graph be replayed, and the history prefix shared with
+    the previous turn does not need to be prefilled again. Entries past the returned length are stale but
+    masked out by the causal mask until they are overwritten.
+    """
+    global chat_kv_cache, chat_cache_ids
+    if chat_kv_cache is None or chat_kv_cache.max_cache_len < max_len:
+        chat_kv_cache = StaticCache(
+            config=model.config,
+            max_batch_size=1,
+            max_cache_len=max(CHAT_MAX_CACHE_LEN, max_len),
+            device=model.device,
+            dtype=model.dtype,
+        )
+        chat_cache_ids = None
+
+    if chat_cache_ids is None:
+        return chat_kv_cache, 0
+
+    n = min(len(chat_cache_ids), len(prompt_ids))
+    mismatch = (chat_cache_ids[:n] != prompt_ids[:n]).nonzero()
+    if len(mismatch):
+        n = mismatch[0].item()
+    # always prefill at least the last prompt token to get the next-token logits
+    return chat_kv_cache, min(n, len(prompt_ids) - 1)
 
 
 @gpu_decorator
-def generate_response(messages, model, tokenizer):
+@torch.inference_mode()
+def generate_response(messages, model, tokenizer, max_new_tokens=CHAT_MAX_NEW_TOKENS):
     """Generate response using Qwen"""
+    global chat_cache_ids, chat_prompt_text, chat_prompt_ids
+
     text = tokenizer.apply_chat_template(
         messages,
         tokenize=False,
         add_generation_prompt=True,
     )
 
-    model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
-    generated_ids = model.generate(
-        **model_inputs,
-        max_new_tokens=512,
-        temperature=0.7,
-        top_p=0.95,
+    if chat_prompt_text is not None and text.startswith(chat_prompt_text):
+        # same conversation as the previous turn, tokenize only the reply and the new messages
+        delta_ids = tokenizer([text[len(chat_prompt_text) :]], return_tensors="pt", add_special_tokens=False).input_ids
+        prompt_ids = torch.cat((chat_prompt_ids, delta_ids), dim=-1)
+    else:
+        prompt_ids = tokenizer([text], return_tensors="pt").input_ids
+    chat_prompt_text, chat_prompt_ids = text, prompt_ids
+    prompt_len = prompt_ids.shape[-1]
+    max_len = prompt_len + max_new_tokens
+    dev = model.device
+
+    generation_config = model.generation_config
+    eos_token_id = generation_config.eos_token_id
+    eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else next(iter(eos_token_ids))
+
+    cache, cached_len = get_chat_kv_cache(model, prompt_ids[0], max_len)
+    chat_cache_ids = None  # invalid until this turn completes
+
+    # allocate once and fill in place instead of concatenating every step
+    input_ids = torch.full((1, max_len), pad_token_id, dtype=torch.long, device=dev)
+    if dev.type == "cuda":
+        # pinned source so the host -> device copy does not block the host
+        input_ids[:, :prompt_len].copy_(prompt_ids.pin_memory(), non_blocking=True)
+    else:
+        input_ids[:, :prompt_len] = prompt_ids.to(dev)
+
+    # prefill runs eagerly and only on the part of the prompt not already in the cache. only the last position
+    # goes through lm_head, a full (prompt_len, vocab) logits tensor would be thrown away anyway
+    hidden_states = model.get_decoder()(
+        input_ids=input_ids[:, cached_len:prompt_len],
+        cache_position=torch.arange(cached_len, prompt_len, device=dev),
+        past_key_values=cache,
+        use_cache=True,
+        return_dict=False,
+    )[0]
+    logits = model.get_output_embeddings()(hidden_states[:, -1])
+
+    cache_position = torch.tensor([prompt_len], device=dev)
+    cur_len = prompt_len
+    for step in range(max_new_tokens):
+        next_token = sample_next_token(
+            logits.float(),
+            input_ids[:, :cur_len],
+            temperature=0.7,
+            top_p=0.95,
+            top_k=generation_config.top_k,
+            repetition_penalty=generation_config.repetition_penalty,
+        )
+        input_ids[:, cur_len : cur_len + 1] = next_token
+        cur_len += 1
+        if next_token.item() in eos_token_ids or step == max_new_tokens - 1:
+            break
+
+        logits = chat_decode_step(model, input_ids[:, cur_len - 1 : cur_len], cache_position, cache)
+        cache_position += 1
+
+    # the last sampled token was never fed to the model, so it is not in the cache
+    chat_cache_ids = input_ids[0, : cur_len - 1].cpu()
+
+    return tokenizer.decode(input_ids[0, prompt_len:cur_len], skip_special_tokens=True)
+
+
+@functools.cache
+def load_chat_model(model_name="Qwen/Qwen2.5-3B-Instruct"):
+    """Load Qwen and capture the decode step before the first turn"""
+    global chat_decode_step
+    quantization_config = None
+    if torch.cuda.is_available():
+        # decode at batch 1 is bound by weight reads, NF4 weights cut them ~4x (and VRAM from ~6GB to ~2GB)
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_quant_type="nf4",
+        )
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name, torch_dtype="auto", device_map="auto", quantization_config=quantization_config
     )
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    # same as F5-TTS: no compile or warmup forward outside spaces.GPU on ZeroGPU
+    if torch.cuda.is_available() and not USING_SPACES:
+        # bitsandbytes>=0.46 (required in pyproject) registers its 4-bit matmul as a torch custom op, so the NF4
+        # Linears trace without graph breaks
+        chat_decode_step = torch.compile(decode_one_token, mode="reduce-overhead")
+
+        print("Warming up Qwen...")
+        generate_response([{"role": "user", "content": "hola"}], model, tokenizer)
+
+    return model, tokenizer
+
+
+def get_chat_model():
+    with model_load_lock:
+        return load_chat_model()
+
+
+def preload_models():
+    """Load (and, with a local GPU, warm up) F5-TTS, then Qwen, one after the other in a background thread"""
+
+    def load():
+        get_f5tts_model()
+        get_chat_model()
+
+    threading.Thread(target=load, daemon=True).start()
+
+
+# single pass: the empty alternatives put a space on letter/digit boundaries, group 1 is a whole number whose
+# lookarounds act like \b would once those boundaries are split
+_RE_NUMERO = re.compile(r'(?<=[A-Za-z])(?=\d)|(?<=\d)(?=[A-Za-z])|(?<![^\WA-Za-z])(\d+)(?![^\WA-Za-z])')
+
+
+@functools.lru_cache(maxsize=4096)
+def numero_a_palabras(numero):
+    return num2words(int(numero), lang='es')
+
+
+def reemplazar_numero(match):
+    numero = match.group(1)
+    return numero_a_palabras(numero) if numero else " "
 
-    generated_ids = [
-        output_ids[len(input_ids) :] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-    ]
-    return tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
 
 def traducir_numero_a_texto(texto):
-    texto_separado = re.sub(r'([A-Za-z])(\d)', r'\1 \2', texto)
-    texto_separado = re.sub(r'(\d)([A-Za-z])', r'\1 \2', texto_separado)
-    
-    def reemplazar_numero(match):
-        numero = match.group()
-        return num2words(int(numero), lang='es')
+    return _RE_NUMERO.sub(reemplazar_numero, texto)
 
-    texto_traducido = re.sub(r'\b\d+\b', reemplazar_numero, texto_separado)
 
-    return texto_traducido
+# the reference voice is the same every chat turn, keep its clipped wav and transcript around
+REF_CACHE_SIZE = 32
+ref_cache = OrderedDict()
 
-@gpu_decorator
-def infer(
-    ref_audio_orig, ref_text, gen_text, model, remove_silence, cross_fade_duration=0.15, speed=1, show_info=gr.Info
-):
-    ref_audio, ref_text = preprocess_ref_audio_text(ref_audio_orig, ref_text, show_info=show_info)
 
-    ema_model = F5TTS_ema_model
+def preprocess_ref_audio_text_cached(ref_audio_orig, ref_text, show_info=print):
+    # keyed on mtime too, so an edited file at the same path is processed again
+    key = (ref_audio_orig, os.path.getmtime(ref_audio_orig), ref_text)
+    cached = ref_cache.get(key)
+    # the clipped wav lives in the temp dir, process the reference again if it was cleaned up
+    if cached is not None and os.path.exists(cached[0]):
+        ref_cache.move_to_end(key)
+        return cached
 
+    cached = preprocess_ref_audio_text(ref_audio_orig, ref_text, show_info=show_info)
+    ref_cache[key] = cached
+    if len(ref_cache) > REF_CACHE_SIZE:
+        ref_cache.popitem(last=False)
+    return cached
+
+
+def preparar_texto(gen_text):
+    gen_text = gen_text.lower()
     if not gen_text.startswith(" "):
         gen_text = " " + gen_text
     if not gen_text.endswith(". "):
         gen_text += ". "
 
-    gen_text = gen_text.lower()
-    gen_text = traducir_numero_a_texto(gen_text)
+    return traducir_numero_a_texto(gen_text)
+
+
+@gpu_decorator
+def infer(
+    ref_audio_orig,
+    ref_text,
+    gen_text,
+    model,
+    remove_silence,
+    cross_fade_duration=0.15,
+    speed=1,
+    show_info=gr.Info,
+    return_spectrogram=True,
+):
+    ref_audio, ref_text = preprocess_ref_audio_text_cached(ref_audio_orig, ref_text, show_info=show_info)
+
+    ema_model = get_f5tts_model()
+
+    gen_text = preparar_texto(gen_text)
 
     final_wave, final_sample_rate, combined_spectrogram = infer_process(
         ref_audio,
         ref_text,
         gen_text,
         ema_model,
-        vocoder,
+        get_vocoder(),
         cross_fade_duration=cross_fade_duration,
         speed=speed,
         show_info=show_info,
@@ -115,45 +390,112 @@ def infer(
 
     # Remove silence
     if remove_silence:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as f:
-            sf.write(f.name, final_wave, final_sample_rate)
-            remove_silence_for_generated_wav(f.name)
-            final_wave, _ = torchaudio.load(f.name)
-        final_wave = final_wave.squeeze().cpu().numpy()
+        final_wave = remove_silence_from_array(final_wave, final_sample_rate)
 
     # Save the spectrogram
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp_spectrogram:
-        spectrogram_path = tmp_spectrogram.name
-        save_spectrogram(combined_spectrogram, spectrogram_path)
+    spectrogram_path = None
+    if return_spectrogram:
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp_spectrogram:
+            spectrogram_path = tmp_spectrogram.name
+            save_spectrogram(combined_spectrogram, spectrogram_path)
 
     return (final_sample_rate, final_wave), spectrogram_path
 
 
-def parse_speechtypes_text(gen_text):
-    # Pattern to find {speechtype}
-    pattern = r"\{(.*?)\}"
+# Pattern to find {speechtype}
+_RE_SPEECHTYPE = re.compile(r"\{(.*?)\}")
 
-    # Split the text by the pattern
-    tokens = re.split(pattern, gen_text)
+
+def parse_speechtypes_text(gen_text):
+    # Split the text by the pattern, tokens alternate text and style starting with text
+    tokens = _RE_SPEECHTYPE.split(gen_text)
 
     segments = []
 
     current_style = "Regular"
 
-    for i in range(len(tokens)):
-        if i % 2 == 0:
-            # This is text
-            text = tokens[i].strip()
-            if text:
-                segments.append({"style": current_style, "text": text})
-        else:
-            # This is style
-            style = tokens[i].strip()
-            current_style = style
+    it = iter(tokens)
+    for text in it:
+        text = text.strip()
+        if text:
+            segments.append({"style": current_style, "text": text})
+
+        style = next(it, None)
+        if style is not None:
+            current_style = style.strip()
 
     return segments
 
 
+@gpu_decorator
+def infer_batch(
+    ref_audio_orig, ref_text, segments, remove_silence=False, cross_fade_duration=0.15, speed=1, show_info=print
+):
+    """Generate the segments of parse_speechtypes_text(), one batched DiT forward per speech type.
+
+    ref_audio_orig and ref_text are either a single reference or dicts keyed by style.
+    """
+
+    def reference(style):
+        return (
+            ref_audio_orig[style] if isinstance(ref_audio_orig, dict) else ref_audio_orig,
+            ref_text[style] if isinstance(ref_text, dict) else ref_text,
+        )
+
+    if not segments:
+        return None
+    if len(segments) == 1:
+        audio, _ = infer(
+            *reference(segments[0]["style"]),
+            segments[0]["text"],
+            "F5-TTS",
+            remove_silence,
+            cross_fade_duration=cross_fade_duration,
+            speed=speed,
+            show_info=show_info,
+            return_spectrogram=False,
+        )
+        return audio
+
+    ema_model = get_f5tts_model()
+
+    # segments sharing a style share a reference, so they can go through the DiT together
+    groups = {}
+    for idx, segment in enumerate(segments):
+        groups.setdefault(segment["style"], []).append(idx)
+
+    waves = [None] * len(segments)
+    for style, idxs in groups.items():
+        style_ref_audio, style_ref_text = reference(style)
+        ref_audio, style_ref_text = preprocess_ref_audio_text_cached(
+            style_ref_audio, style_ref_text, show_info=show_info
+        )
+        results = infer_process(
+            ref_audio,
+            style_ref_text,
+            [preparar_texto(segments[idx]["text"]) for idx in idxs],
+            ema_model,
+            get_vocoder(),
+            cross_fade_duration=cross_fade_duration,
+            speed=speed,
+            show_info=show_info,
+        )
+        for idx, (wave, sample_rate, _) in zip(idxs, results):
+            waves[idx] = wave
+
+    final_wave = cross_fade_waves(waves, cross_fade_duration)
+    if remove_silence:
+        final_wave = remove_silence_from_array(final_wave, sample_rate)
+
+    return sample_rate, final_wave
+
+
+if USING_SPACES:
+    # on Spaces the module is the entrypoint, load the models while the UI below is built. this is a plain
+    # load only: the loaders skip compile and warmup there, the first request runs inside spaces.GPU
+    preload_models()
+
+
 ########## INICIA GRADIO PRINCIPAL ##########
 with gr.Blocks() as app_chat:
     gr.Markdown(
@@ -164,11 +506,6 @@ with gr.Blocks() as app_chat:
 
     chat_interface_container = gr.Column()
 
-    if chat_model_state is None:
-        model_name = "Qwen/Qwen2.5-3B-Instruct"
-        chat_model_state = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype="auto", device_map="auto")
-        chat_tokenizer_state = AutoTokenizer.from_pretrained(model_name)
-
     # Construir rutas absolutas a los assets
     ASSETS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "Assets"))
     initial_prompt_path = os.path.join(ASSETS_DIR, "Initial_Prompt.txt")
@@ -267,13 +604,19 @@ with gr.Blocks() as app_chat:
         if not text.strip():
             return history, conv_state
 
+        # keep the system prompt and the last turns, bounds the prompt the chat model has to attend to.
+        # trimming in blocks changes the prompt prefix (and forces a full prefill) only every few turns
+        if len(conv_state) > 3 * CHAT_HISTORY_MAX_TURNS + 1:
+            conv_state = [conv_state[0]] + conv_state[-3 * CHAT_HISTORY_TURNS :]
+
         # --- RAG: Recupera contexto relevante ---
         contexto = " ".join(retrieve_context(text, top_k=3))
         # Puedes incluir el contexto como parte del mensaje del sistema o del usuario
         conv_state.append({"role": "system", "content": f"Contexto relevante: {contexto}"})
         conv_state.append({"role": "user", "content": text})
 
-        response = generate_response(conv_state, chat_model_state, chat_tokenizer_state)
+        chat_model, chat_tokenizer = get_chat_model()
+        response = generate_response(conv_state, chat_model, chat_tokenizer)
         conv_state.append({"role": "assistant", "content": response})
 
         if not history:
@@ -305,7 +648,8 @@ with gr.Blocks() as app_chat:
             remove_silence,
             cross_fade_duration=0.15,
             speed=1.0,
-            show_info=print
+            show_info=print,
+            return_spectrogram=False,  # the chat UI only plays the audio
         )
         return audio_result
 
@@ -404,11 +748,13 @@ with gr.Blocks() as app:
     is_flag=True,
     help="Compartir la aplicación a través de un enlace compartido de Gradio",
 )
-@click.option("--api", "-a", default=True, is_flag=True, help="Permitir acceso a la API")
+@click.option("--api", "-a", default=False, is_flag=True, help="Permitir acceso a la API")
 def main(port, host, share, api):
     global app
     print("Iniciando la aplicación...")
-    app.queue(api_open=api).launch(server_name=host, server_port=port, share=True, show_api=api)
+    # the UI is already built at import, this overlaps the model loads with the server launch
+    preload_models()
+    app.queue(api_open=api).launch(server_name=host, server_port=port, share=share, show_api=api)
 
 
 if __name__ == "__main__":
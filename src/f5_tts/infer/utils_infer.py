@@ -8,6 +8,7 @@ sys.path.append(f"../../{os.path.dirname(os.path.abspath(__file__))}/third_party
 import hashlib
 import re
 import tempfile
+from contextlib import nullcontext
 from importlib.resources import files
 
 import matplotlib
@@ -49,6 +50,7 @@ cfg_strength = 2.0
 sway_sampling_coef = -1.0
 speed = 1.0
 fix_duration = None
+max_batch_size = 4  # chunks per stacked sample() call, the DiT sees twice as many rows with CFG
 
 # -----------------------------------------
 
@@ -334,10 +336,35 @@ def infer_process(
     speed=speed,
     fix_duration=fix_duration,
     device=device,
+    max_batch_size=max_batch_size,
 ):
     # Split the input text into batches
     audio, sr = torchaudio.load(ref_audio)
     max_chars = int(len(ref_text.encode("utf-8")) / (audio.shape[-1] / sr) * (25 - audio.shape[-1] / sr))
+
+    # a list of texts is generated side by side, returns one (wave, sr, spectrogram) per text
+    if isinstance(gen_text, list):
+        gen_text_batches = [chunk_text(text, max_chars=max_chars) for text in gen_text]
+        show_info(f"Generating {len(gen_text)} texts in one batch...")
+        return infer_stacked_process(
+            (audio, sr),
+            ref_text,
+            gen_text_batches,
+            model_obj,
+            vocoder,
+            mel_spec_type=mel_spec_type,
+            progress=progress,
+            target_rms=target_rms,
+            cross_fade_duration=cross_fade_duration,
+            nfe_step=nfe_step,
+            cfg_strength=cfg_strength,
+            sway_sampling_coef=sway_sampling_coef,
+            speed=speed,
+            fix_duration=fix_duration,
+            device=device,
+            max_batch_size=max_batch_size,
+        )
+
     gen_text_batches = chunk_text(gen_text, max_chars=max_chars)
     for i, gen_text in enumerate(gen_text_batches):
         print(f"gen_text {i}", gen_text)
@@ -362,6 +389,66 @@ def infer_process(
     )
 
 
+# normalize reference audio: mono, loudness, sample rate
+
+
+def prepare_ref_audio(ref_audio, target_rms=0.1, device=None):
+    audio, sr = ref_audio
+    if audio.shape[0] > 1:
+        audio = torch.mean(audio, dim=0, keepdim=True)
+
+    rms = torch.sqrt(torch.mean(torch.square(audio)))
+    if rms < target_rms:
+        audio = audio * target_rms / rms
+    if sr != target_sample_rate:
+        resampler = torchaudio.transforms.Resample(sr, target_sample_rate)
+        audio = resampler(audio)
+    return audio.to(device), rms
+
+
+# copy a tensor to host, asynchronously through pinned memory if it lives on cuda
+
+
+def to_host(tensor):
+    if tensor.device.type != "cuda":
+        return tensor.cpu()
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    host.copy_(tensor, non_blocking=True)
+    return host
+
+
+# estimate the mel frames (reference included) to generate for a chunk of text
+
+
+def chunk_duration(ref_audio_len, ref_text, gen_text, speed=1, fix_duration=None):
+    if fix_duration is not None:
+        return int(fix_duration * target_sample_rate / hop_length)
+    # Calculate duration
+    ref_text_len = len(ref_text.encode("utf-8"))
+    gen_text_len = len(gen_text.encode("utf-8"))
+    return ref_audio_len + int(ref_audio_len / ref_text_len * gen_text_len / speed)
+
+
+# vocode a generated mel (b=1) and copy wave and mel to host, on the side stream when one is given
+
+
+def vocode_chunk(generated_mel_spec, vocoder, mel_spec_type, rms, target_rms, vocoder_stream=None):
+    if vocoder_stream is not None:
+        vocoder_stream.wait_stream(torch.cuda.current_stream(generated_mel_spec.device))
+        generated_mel_spec.record_stream(vocoder_stream)
+
+    with torch.cuda.stream(vocoder_stream) if vocoder_stream is not None else nullcontext():
+        if mel_spec_type == "vocos":
+            generated_wave = vocoder.decode(generated_mel_spec)
+        elif mel_spec_type == "bigvgan":
+            generated_wave = vocoder(generated_mel_spec)
+        if rms < target_rms:
+            generated_wave = generated_wave * rms / target_rms
+
+        # wav -> host, non blocking into pinned memory on cuda
+        return to_host(generated_wave.squeeze()), to_host(generated_mel_spec[0])
+
+
 # infer batches
 
 
@@ -382,17 +469,10 @@ def infer_batch_process(
     fix_duration=None,
     device=None,
 ):
-    audio, sr = ref_audio
-    if audio.shape[0] > 1:
-        audio = torch.mean(audio, dim=0, keepdim=True)
+    audio, rms = prepare_ref_audio(ref_audio, target_rms=target_rms, device=device)
 
-    rms = torch.sqrt(torch.mean(torch.square(audio)))
-    if rms < target_rms:
-        audio = audio * target_rms / rms
-    if sr != target_sample_rate:
-        resampler = torchaudio.transforms.Resample(sr, target_sample_rate)
-        audio = resampler(audio)
-    audio = audio.to(device)
+    # on cuda, vocoder and device -> host copies of a chunk run on a side stream, overlapping the next chunk's DiT
+    vocoder_stream = torch.cuda.Stream(audio.device) if audio.device.type == "cuda" else None
 
     generated_waves = []
     spectrograms = []
@@ -405,13 +485,7 @@ def infer_batch_process(
         final_text_list = convert_char_to_pinyin(text_list)
 
         ref_audio_len = audio.shape[-1] // hop_length
-        if fix_duration is not None:
-            duration = int(fix_duration * target_sample_rate / hop_length)
-        else:
-            # Calculate duration
-            ref_text_len = len(ref_text.encode("utf-8"))
-            gen_text_len = len(gen_text.encode("utf-8"))
-            duration = ref_audio_len + int(ref_audio_len / ref_text_len * gen_text_len / speed)
+        duration = chunk_duration(ref_audio_len, ref_text, gen_text, speed=speed, fix_duration=fix_duration)
 
         # inference
         with torch.inference_mode():
@@ -427,20 +501,30 @@ def infer_batch_process(
             generated = generated.to(torch.float32)
             generated = generated[:, ref_audio_len:, :]
             generated_mel_spec = generated.permute(0, 2, 1)
-            if mel_spec_type == "vocos":
-                generated_wave = vocoder.decode(generated_mel_spec)
-            elif mel_spec_type == "bigvgan":
-                generated_wave = vocoder(generated_mel_spec)
-            if rms < target_rms:
-                generated_wave = generated_wave * rms / target_rms
-
-            # wav -> numpy
-            generated_wave = generated_wave.squeeze().cpu().numpy()
-
+            generated_wave, spectrogram = vocode_chunk(
+                generated_mel_spec, vocoder, mel_spec_type, rms, target_rms, vocoder_stream=vocoder_stream
+            )
             generated_waves.append(generated_wave)
-            spectrograms.append(generated_mel_spec[0].cpu().numpy())
+            spectrograms.append(spectrogram)
+
+    if vocoder_stream is not None:
+        vocoder_stream.synchronize()
+    generated_waves = [generated_wave.numpy() for generated_wave in generated_waves]
+    spectrograms = [spectrogram.numpy() for spectrogram in spectrograms]
 
     # Combine all generated waves with cross-fading
+    final_wave = cross_fade_waves(generated_waves, cross_fade_duration)
+
+    # Create a combined spectrogram
+    combined_spectrogram = np.concatenate(spectrograms, axis=1)
+
+    return final_wave, target_sample_rate, combined_spectrogram
+
+
+# combine generated waves with cross-fading
+
+
+def cross_fade_waves(generated_waves, cross_fade_duration=0.15):
     if cross_fade_duration <= 0:
         # Simply concatenate
         final_wave = np.concatenate(generated_waves)
@@ -477,27 +561,130 @@ def infer_batch_process(
 
             final_wave = new_wave
 
-    # Create a combined spectrogram
-    combined_spectrogram = np.concatenate(spectrograms, axis=1)
+    return final_wave
 
-    return final_wave, target_sample_rate, combined_spectrogram
+
+# infer several texts at once: the chunks of every text are stacked along the batch dim of sample() calls,
+# at most max_batch_size at a time
+
+
+def infer_stacked_process(
+    ref_audio,
+    ref_text,
+    gen_text_batches,
+    model_obj,
+    vocoder,
+    mel_spec_type="vocos",
+    progress=tqdm,
+    target_rms=0.1,
+    cross_fade_duration=0.15,
+    nfe_step=32,
+    cfg_strength=2.0,
+    sway_sampling_coef=-1,
+    speed=1,
+    fix_duration=None,
+    device=None,
+    max_batch_size=4,
+    max_duration=4096,
+):
+    audio, rms = prepare_ref_audio(ref_audio, target_rms=target_rms, device=device)
+
+    if len(ref_text[-1].encode("utf-8")) == 1:
+        ref_text = ref_text + " "
+
+    chunks = [gen_text for text_batches in gen_text_batches for gen_text in text_batches]
+
+    # Prepare the text
+    text_list = [ref_text + gen_text for gen_text in chunks]
+    final_text_list = convert_char_to_pinyin(text_list)
+
+    ref_audio_len = audio.shape[-1] // hop_length
+    vocoder_stream = torch.cuda.Stream(audio.device) if audio.device.type == "cuda" else None
+
+    generated_waves = []
+    spectrograms = []
+    with torch.inference_mode():
+        # mel of the reference once, instead of once per stacked row inside sample()
+        cond = model_obj.mel_spec(audio).permute(0, 2, 1)
+        cond_seq_len = cond.shape[1]
+
+        # sample() raises every duration past the reference / text length and caps it, the output is
+        # sliced below with the same bounds so no generated frame is dropped
+        durations = []
+        for gen_text, final_text in zip(chunks, final_text_list):
+            duration = chunk_duration(ref_audio_len, ref_text, gen_text, speed=speed, fix_duration=fix_duration)
+            lens = max(len(final_text), cond_seq_len)
+            durations.append(min(max(lens + 1, duration), max_duration))
+
+        # inference, noise latents of each chunk are padded to the longest one in its batch and masked
+        for start in progress.tqdm(range(0, len(chunks), max_batch_size)):
+            batch_durations = durations[start : start + max_batch_size]
+            generated, _ = model_obj.sample(
+                cond=cond.repeat(len(batch_durations), 1, 1),
+                text=final_text_list[start : start + max_batch_size],
+                duration=torch.tensor(batch_durations, dtype=torch.long, device=audio.device),
+                steps=nfe_step,
+                cfg_strength=cfg_strength,
+                sway_sampling_coef=sway_sampling_coef,
+                max_duration=max_duration,
+            )
+            generated = generated.to(torch.float32)
+
+            for i, duration in enumerate(batch_durations):
+                generated_mel_spec = generated[i : i + 1, ref_audio_len:duration, :].permute(0, 2, 1)
+                generated_wave, spectrogram = vocode_chunk(
+                    generated_mel_spec, vocoder, mel_spec_type, rms, target_rms, vocoder_stream=vocoder_stream
+                )
+                generated_waves.append(generated_wave)
+                spectrograms.append(spectrogram)
+
+    if vocoder_stream is not None:
+        vocoder_stream.synchronize()
+    generated_waves = [generated_wave.numpy() for generated_wave in generated_waves]
+    spectrograms = [spectrogram.numpy() for spectrogram in spectrograms]
+
+    # regroup the chunks of each text and cross-fade them
+    results = []
+    start = 0
+    for text_batches in gen_text_batches:
+        end = start + len(text_batches)
+        final_wave = cross_fade_waves(generated_waves[start:end], cross_fade_duration)
+        combined_spectrogram = np.concatenate(spectrograms[start:end], axis=1)
+        results.append((final_wave, target_sample_rate, combined_spectrogram))
+        start = end
+
+    return results
 
 
 # remove silence from generated wav
 
 
-def remove_silence_for_generated_wav(filename):
-    aseg = AudioSegment.from_file(filename)
+def remove_silence_segments(aseg):
     non_silent_segs = silence.split_on_silence(
         aseg, min_silence_len=1000, silence_thresh=-50, keep_silence=500, seek_step=10
     )
-    non_silent_wave = AudioSegment.silent(duration=0)
+    non_silent_wave = AudioSegment.silent(duration=0, frame_rate=aseg.frame_rate)
     for non_silent_seg in non_silent_segs:
         non_silent_wave += non_silent_seg
-    aseg = non_silent_wave
+    return non_silent_wave
+
+
+def remove_silence_for_generated_wav(filename):
+    aseg = AudioSegment.from_file(filename)
+    aseg = remove_silence_segments(aseg)
     aseg.export(filename, format="wav")
 
 
+# same as above on an in-memory float wave, skips the wav file round-trip
+
+
+def remove_silence_from_array(wave, sample_rate):
+    pcm = (np.clip(wave, -1.0, 1.0) * 32767).astype(np.int16)
+    aseg = AudioSegment(pcm.tobytes(), frame_rate=sample_rate, sample_width=2, channels=1)
+    aseg = remove_silence_segments(aseg)
+    return np.array(aseg.get_array_of_samples(), dtype=np.float32) / 32768
+
+
 # save spectrogram
 
 
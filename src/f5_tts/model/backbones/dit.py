@@ -136,6 +136,7 @@ class DiT(nn.Module):
         drop_audio_cond,  # cfg for cond audio
         drop_text,  # cfg for text
         mask: bool["b n"] | None = None,  # noqa: F722
+        cfg_infer: bool = False,  # pack cond & uncond forward into one batch
     ):
         batch, seq_len = x.shape[0], x.shape[1]
         if time.ndim == 0:
@@ -143,8 +144,17 @@ class DiT(nn.Module):
 
         # t: conditioning time, c: context (text + masked cond audio), x: noised input audio
         t = self.time_embed(time)
-        text_embed = self.text_embed(text, seq_len, drop_text=drop_text)
-        x = self.input_embed(x, cond, text_embed, drop_audio_cond=drop_audio_cond)
+        if cfg_infer:  # b n d -> 2b n d, cond first then uncond
+            text_embed = self.text_embed(text, seq_len, drop_text=False)
+            text_embed_null = self.text_embed(text, seq_len, drop_text=True)
+            x_cond = self.input_embed(x, cond, text_embed, drop_audio_cond=False)
+            x_uncond = self.input_embed(x, cond, text_embed_null, drop_audio_cond=True)
+            x = torch.cat((x_cond, x_uncond), dim=0)
+            t = torch.cat((t, t), dim=0)
+            mask = torch.cat((mask, mask), dim=0) if mask is not None else None
+        else:
+            text_embed = self.text_embed(text, seq_len, drop_text=drop_text)
+            x = self.input_embed(x, cond, text_embed, drop_audio_cond=drop_audio_cond)
 
         rope = self.rotary_embed.forward_from_seq_len(seq_len)
 
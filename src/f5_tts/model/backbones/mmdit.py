@@ -122,6 +122,7 @@ class MMDiT(nn.Module):
         drop_audio_cond,  # cfg for cond audio
         drop_text,  # cfg for text
         mask: bool["b n"] | None = None,  # noqa: F722
+        cfg_infer: bool = False,  # pack cond & uncond forward into one batch
     ):
         batch = x.shape[0]
         if time.ndim == 0:
@@ -129,8 +130,20 @@ class MMDiT(nn.Module):
 
         # t: conditioning (time), c: context (text + masked cond audio), x: noised input audio
         t = self.time_embed(time)
-        c = self.text_embed(text, drop_text=drop_text)
-        x = self.audio_embed(x, cond, drop_audio_cond=drop_audio_cond)
+        if cfg_infer:  # b n d -> 2b n d, cond first then uncond
+            c = torch.cat((self.text_embed(text, drop_text=False), self.text_embed(text, drop_text=True)), dim=0)
+            x = torch.cat(
+                (
+                    self.audio_embed(x, cond, drop_audio_cond=False),
+                    self.audio_embed(x, cond, drop_audio_cond=True),
+                ),
+                dim=0,
+            )
+            t = torch.cat((t, t), dim=0)
+            mask = torch.cat((mask, mask), dim=0) if mask is not None else None
+        else:
+            c = self.text_embed(text, drop_text=drop_text)
+            x = self.audio_embed(x, cond, drop_audio_cond=drop_audio_cond)
 
         seq_len = x.shape[1]
         text_len = text.shape[1]